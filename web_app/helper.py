@@ -1,89 +1,161 @@
 import pandas as pd
-import numpy as np
 import requests
 from email_validator import validate_email, EmailNotValidError
 import logging
+import threading
+import time
+
+# Regex patterns are kept as strings since Arrow's string kernels take patterns, not compiled objects
+# Single digit hour at the start of a time, e.g. the 9 in '02/09/2019 9:30'
+HOUR_PATTERN = r"\s(\d):"
+# Currency symbols stripped from donation amounts in one pass
+CURRENCY_PATTERN = r"[$,]"
+
+# Columns each input file must contain
+EXP_C_COLS = frozenset(['Patron ID', 'First Name', 'Last Name', 'Date Entered', 'Primary Email', 'Company',
+                        'Salutation', 'Title', 'Tags', 'Gender'])
+EXP_E_COLS = frozenset(['Patron ID', 'Email'])
+EXP_DH_COLS = frozenset(['Patron ID', 'Donation Amount', 'Donation Date', 'Payment Method', 'Campaign', 'Status'])
+
+# Tag mappings rarely change, so reuse them across requests for a few minutes
+TAG_CACHE_TTL = 300
+TAG_API_TIMEOUT = 5
+_tag_cache = {}
+_tag_lock = threading.Lock()
+_session = requests.Session()
 
 def get_mapped_tags(url):
     '''
-    Retrieves dictionary format of tag mappings
+    Retrieves dictionary format of tag mappings, reusing the last successful response for TAG_CACHE_TTL seconds
     
     Args:
         url (str): API url containing mappings
     
     Returns:
-        dict: key: original tag, value: mapped tag, or empty dict if url is inaccessible
+        dict: key: original tag, value: mapped tag, the last cached mapping if url is inaccessible,
+        or empty dict if there is none
     '''
-    response = requests.get(url)
-    if response.status_code == 200:
-        tags = response.json()
-        mapped_tags = {t['name'].strip(): t['mapped_name'].strip() for t in tags}
-        return mapped_tags
-    else:
-        logging.error(f'Error: Could not access tag mapping API at {url}')
-        return {}
+    cached = _tag_cache.get(url)
+    if cached is not None and time.monotonic() - cached[0] < TAG_CACHE_TTL:
+        return cached[1]
+    # Only one thread refreshes the mapping, the rest wait and reuse its result
+    with _tag_lock:
+        cached = _tag_cache.get(url)
+        if cached is not None and time.monotonic() - cached[0] < TAG_CACHE_TTL:
+            return cached[1]
+        try:
+            response = _session.get(url, timeout=TAG_API_TIMEOUT)
+        except requests.RequestException:
+            response = None
+        if response is not None and response.status_code == 200:
+            tags = response.json()
+            mapped_tags = {t['name'].strip(): t['mapped_name'].strip() for t in tags}
+            _tag_cache[url] = (time.monotonic(), mapped_tags)
+            return mapped_tags
+        elif cached is not None:
+            logging.error(f'Error: Could not access tag mapping API at {url}, using the last cached mapping')
+            return cached[1]
+        else:
+            logging.error(f'Error: Could not access tag mapping API at {url}')
+            return {}
 
 def map_tags(tags, mapping):
     '''
     Map comma-separated tags using the mapping dictionary
 
     Args:
-        tags (str): comma-separated string of tags
+        tags (pd.Series): comma-separated strings of tags
         mapping (dict): mapping original tags to new tags
     
     Returns:
-        str: comma-separated mapped tags or NaN if no tags provided
+        pd.Series: comma-separated mapped tags, or NaN where no tags provided
+        pd.Series: one mapped tag per entry, indexed by the row of tags it came from
     '''
-    if pd.notnull(tags):
-        mapped_tags = [mapping.get(t.strip(), t.strip()) for t in tags.split(',')]
-        mapped_tags = set(mapped_tags)
-        return ', '.join(mapped_tags)
-    else:
-        return float('nan')
+    exploded = tags.dropna().str.split(',').explode().str.strip()
+    exploded = exploded.map(mapping).fillna(exploded)
+    # Duplicates are dropped per row while keeping the first-seen order
+    pairs = pd.DataFrame({'row': exploded.index, 'tag': exploded.to_numpy()}).drop_duplicates()
+    exploded = pairs.set_index('row')['tag'].rename_axis(None)
+    mapped_tags = exploded.groupby(level=0, sort=False).agg(', '.join)
+    return mapped_tags.reindex(tags.index), exploded
 
-def replace_invalid_email(entry, emails_df):
+def is_deliverable_domain(domain):
     '''
-    Validate primary email. If invalid, replace with backup email associated with the same Patron ID.
+    Check whether a domain can receive email
 
     Args:
-        entry (pd.Series): A row of the c_df Dataframe
-        emails_df (pd.Dataframe): The emails Dataframe containing all valid emails
+        domain (str): domain part of an email address
     
     Returns:
-        str: valid email address for the email 1 column, or NaN if a valid email is not found
+        bool: True if the domain passes the DNS deliverability check, False otherwise
     '''
     try:
-        validate_email(entry['Primary Email'], check_deliverability=True)
-        return entry['Primary Email']
-    except (EmailNotValidError, AttributeError):
-        if pd.isna(entry["Primary Email"]):
-            logging.error(f'{entry["Patron ID"]} did not provide a primary email')
+        validate_email(f'postmaster@{domain}', check_deliverability=True)
+        return True
+    except EmailNotValidError:
+        return False
+
+def valid_email_mask(emails, checked_domains):
+    '''
+    Validate a column of emails at once
+
+    Args:
+        emails (pd.Series): email addresses, possibly containing NaN
+        checked_domains (dict): deliverability results for this request, filled in as new domains are checked
+    
+    Returns:
+        pd.Series: boolean mask, True where the email is well formed and its domain is deliverable
+    '''
+    # Syntax is checked once per unique address, deliverability once per domain
+    valid_emails = []
+    for e in emails.dropna().unique():
+        try:
+            domain = validate_email(e, check_deliverability=False).ascii_domain
+        except EmailNotValidError:
+            continue
+        if domain not in checked_domains:
+            checked_domains[domain] = is_deliverable_domain(domain)
+        if checked_domains[domain]:
+            valid_emails.append(e)
+    return emails.isin(valid_emails)
+
+def replace_invalid_email(c_df, emails_df, checked_domains):
+    '''
+    Validate primary emails. If invalid, replace with backup email associated with the same Patron ID.
+
+    Args:
+        c_df (pd.Dataframe): dataframe containing the main constituent data
+        emails_df (pd.Dataframe): The emails Dataframe containing all valid emails, indexed by Patron ID
+        checked_domains (dict): deliverability results for this request, shared with valid_email_mask
+    Returns:
+        pd.Series: valid email addresses for the email 1 column, NaN where a valid email is not found
+    '''
+    valid_mask = valid_email_mask(c_df['Primary Email'], checked_domains)
+    invalid = c_df.loc[~valid_mask, ['Patron ID', 'Primary Email']]
+    for pid, email in zip(invalid['Patron ID'].to_numpy(), invalid['Primary Email'].to_numpy()):
+        if pd.isna(email):
+            logging.error(f'{pid} did not provide a primary email')
         else:
-            logging.error(f'{entry["Patron ID"]} provided invalid primary email: {entry["Primary Email"]}')
-        return emails_df.loc[entry['Patron ID'], 'Email'] if entry['Patron ID'] in emails_df.index else float('nan')
+            logging.error(f'{pid} provided invalid primary email: {email}')
+    fallback = c_df['Patron ID'].map(emails_df['Email'])
+    return c_df['Primary Email'].where(valid_mask, fallback)
 
-def normalize_dates(date):
+def normalize_dates(dates):
     '''
-    Convert date string into standardized datetime format
+    Convert a column of date strings into standardized datetime format
 
     Args:
-        date (str): String representing some date + time optionally
+        dates (pd.Series): Strings representing some date + time optionally
     
     Returns:
-        datetime.datetime: normalized datetime object, or NaN if no date provided/date could not be parsed
-    '''
-    if pd.notnull(date):
-        if ':' in date:
-            d, t = date.split()
-            h, m = t.split(':')
-            h = h.zfill(2)
-            date = f'{d} {h}:{m}'
-        normalized_date = pd.to_datetime(date, errors='coerce')
-        if pd.isna(normalized_date):
-            logging.error(f'Could not convert {date} to readable format')
-        return normalized_date
-    else:
-        return float('nan')
+        pd.Series: normalized datetimes, or NaT if no date provided/date could not be parsed
+    '''
+    # Zero-pad single digit hours so every time reads as HH:MM
+    dates = dates.str.replace(HOUR_PATTERN, r' 0\1:', regex=True)
+    normalized_dates = pd.to_datetime(dates, errors='coerce', format='mixed')
+    for date in dates[normalized_dates.isna() & dates.notna()].tolist():
+        logging.error(f'Could not convert {date} to readable format')
+    return normalized_dates
 
 def validate_data(c_df, emails_df, dhist_df):
     '''
@@ -99,12 +171,9 @@ def validate_data(c_df, emails_df, dhist_df):
         str: Message to be printed to screen if data cannot be parsed, empty string otherwise
     '''
     # Ensure all necessary columns are present, cannot continue if false
-    column_lists = [c_df.columns.tolist(), emails_df.columns.tolist(), dhist_df.columns.tolist()]
-    exp_columns = [['Patron ID', 'First Name', 'Last Name', 'Date Entered', 'Primary Email', 'Company', 'Salutation', 'Title', 'Tags', 'Gender'], 
-                   ['Patron ID', 'Email'], ['Patron ID', 'Donation Amount', 'Donation Date', 'Payment Method', 'Campaign', 'Status']]
-    for i in range(len(column_lists)):
-        if set(column_lists[i]) != set(exp_columns[i]):
-            return False, 'Ensure that columns adhere to the samples'
+    if (frozenset(c_df.columns) != EXP_C_COLS or frozenset(emails_df.columns) != EXP_E_COLS
+            or frozenset(dhist_df.columns) != EXP_DH_COLS):
+        return False, 'Ensure that columns adhere to the samples'
     
     # Verify all Patron IDs are unique in constituents input, should not continue if false
     # Might break logic but sample does not so temporarily just log the error for presentation purposes
@@ -113,7 +182,8 @@ def validate_data(c_df, emails_df, dhist_df):
 
     # Verify all donations are in valid format and all greater than 0
     try:
-        dhist_df['Donation Amount'] = dhist_df['Donation Amount'].str.replace('$', '').str.replace(',', '').astype(float)
+        # Parsed in place so gen_constituents reuses the numeric column
+        dhist_df['Donation Amount'] = dhist_df['Donation Amount'].str.replace(CURRENCY_PATTERN, '', regex=True).astype('float64')
     except ValueError:
         return False, 'Invalid donation amount format detected'
     
@@ -133,24 +203,21 @@ def gen_constituents(c_df, emails_df, dhist_df):
     
     Returns:
         pd.Dataframe: dataframe containing new/existing data according to the client requirements
+        pd.Series: every mapped tag in the output, one entry per tag per constituent
     '''
     mapped_tags = get_mapped_tags('https://6719768f7fc4c5ff8f4d84f1.mockapi.io/api/v1/tags')
-    # Filter valid emails only
-    valid_map = []
-    for e in emails_df['Email']:
-        try:
-            validate_email(e, check_deliverability=True)
-            valid_map.append(True)
-        except EmailNotValidError:
-            logging.error(f'Invalid email detected in Emails file: {e}')
-            valid_map.append(False)
-    emails_df = emails_df[valid_map]
+    # Filter valid emails only, each domain's deliverability is checked once per request
+    checked_domains = {}
+    valid_mask = valid_email_mask(emails_df['Email'], checked_domains)
+    for e in emails_df.loc[~valid_mask, 'Email'].tolist():
+        logging.error(f'Invalid email detected in Emails file: {e}')
+    emails_df = emails_df[valid_mask]
 
     # Determine donation details
-    dhist_df = dhist_df[dhist_df['Status'] == 'Paid']
-    most_recent_donations = dhist_df.loc[dhist_df.groupby('Patron ID')['Donation Date'].idxmax(),
-                                         ['Patron ID', 'Donation Date', 'Donation Amount']]
-    lt_donations = dhist_df.groupby('Patron ID').agg(lifetime_donations=('Donation Amount', 'sum'))
+    # Newest donations first so each patron's first row is their most recent donation, ties keep file order
+    dhist_df = dhist_df[dhist_df['Status'] == 'Paid'].sort_values('Donation Date', ascending=False, kind='stable')
+    most_recent_donations = dhist_df.drop_duplicates('Patron ID')[['Patron ID', 'Donation Date', 'Donation Amount']]
+    lt_donations = dhist_df.groupby('Patron ID', sort=False).agg(lifetime_donations=('Donation Amount', 'sum'))
     donation_details = lt_donations.merge(most_recent_donations, on='Patron ID')
     donation_details['lifetime_donations'] = donation_details['lifetime_donations'].map('${:,.2f}'.format)
     donation_details['Donation Amount'] = donation_details['Donation Amount'].map('${:,.2f}'.format)
@@ -160,29 +227,27 @@ def gen_constituents(c_df, emails_df, dhist_df):
     t_conds = [c_df['First Name'].notnull() & c_df['Last Name'].notnull(), 
                c_df['Company'].notnull() & ~c_df['Company'].str.lower().isin(non_company_words)]
     t_choices = ['Person', 'Company']
-    c_df['type'] = np.select(t_conds, t_choices, default='Unknown')
-    c_df.insert(loc=1, column='type', value=c_df.pop('type'))
+    c_df['type'] = pd.Series('Unknown', index=c_df.index).case_when(list(zip(t_conds, t_choices)))
     # Standardize dates for created_at
-    c_df['Date Entered'] = c_df['Date Entered'].apply(normalize_dates)
+    c_df['Date Entered'] = normalize_dates(c_df['Date Entered'])
     c_df['Date Entered'] = c_df['Date Entered'].dt.strftime('%Y-%m-%d %H:%M:%S')
     # Set email 1
-    unique_emails = emails_df.groupby('Patron ID').first()
-    c_df['Primary Email'] = c_df.apply(replace_invalid_email, axis=1, emails_df=unique_emails)
+    unique_emails = emails_df.groupby('Patron ID', sort=False).first()
+    c_df['Primary Email'] = replace_invalid_email(c_df, unique_emails, checked_domains)
     # Set email 2
-    temp_df = c_df.merge(emails_df, on='Patron ID', how='left')
+    temp_df = c_df[['Patron ID', 'Primary Email']].merge(emails_df, on='Patron ID', how='left')
     temp_df = temp_df[temp_df['Primary Email'] != temp_df['Email']]
-    secondary_emails = temp_df.groupby('Patron ID')['Email'].first().rename('email2')
-    c_df = c_df.merge(secondary_emails, on='Patron ID', how='left')
-    c_df['email2'] = c_df['email2'].replace([None], float('nan'))
-    c_df.insert(loc=7, column='email2', value=c_df.pop('email2'))
+    secondary_emails = temp_df.groupby('Patron ID', sort=False)['Email'].first()
+    c_df['email2'] = c_df['Patron ID'].map(secondary_emails)
     # Map the tags
-    c_df['Tags'] = c_df['Tags'].apply(map_tags, mapping=mapped_tags)
+    c_df['Tags'], exploded_tags = map_tags(c_df['Tags'], mapped_tags)
     # Determine background info
-    job_title = np.where(c_df['Title'].notnull(), 'Job Title: ' + c_df['Title'], '')
-    marital_status = np.where(c_df['Gender'].notnull() & (c_df['Gender'] != 'Unknown'), 
-                              'Marital Status: ' + c_df['Gender'], '')
-    c_df['background_info'] = np.char.strip((job_title + '; ' + marital_status).astype(np.str_), '; ')
-    c_df.drop(['Title', 'Gender'], axis=1, inplace=True)
+    has_title = c_df['Title'].notnull()
+    has_status = c_df['Gender'].notnull() & (c_df['Gender'] != 'Unknown')
+    job_title = ('Job Title: ' + c_df['Title']).where(has_title, '')
+    marital_status = ('Marital Status: ' + c_df['Gender']).where(has_status, '')
+    separator = pd.Series('', index=c_df.index).mask(has_title & has_status, '; ')
+    c_df['background_info'] = job_title + separator + marital_status
     # Merge donation details
     c_df = c_df.merge(donation_details, on='Patron ID', how='left')
     
@@ -191,26 +256,22 @@ def gen_constituents(c_df, emails_df, dhist_df):
                          'Date Entered': 'created_at', 'Primary Email': 'email1', 'Company': 'company',
                          'Salutation': 'title', 'Tags': 'tags', 'Donation Amount': 'most_recent_donation_amount',
                          'Donation Date': 'most_recent_donation_date'}, inplace=True)
-    c_df.insert(loc=1, column='type', value=c_df.pop('type'))
-    c_df.insert(loc=4, column='company', value=c_df.pop('company'))
-    c_df.insert(loc=7, column='email2', value=c_df.pop('email2'))
+    final_order = ['patron_id', 'type', 'first_name', 'last_name', 'company', 'created_at', 'email1', 'email2',
+                   'title', 'tags', 'background_info', 'lifetime_donations', 'most_recent_donation_date',
+                   'most_recent_donation_amount']
     
-    return c_df
+    return c_df.reindex(columns=final_order), exploded_tags
 
-def gen_tag_counts(c_df):
+def gen_tag_counts(exploded_tags):
     '''
     Generate output tags dataframe as part of the requirements for this project
 
     Args:
-        c_df (pd.Dataframe): out constituents dataframe which contains mapped tags
+        exploded_tags (pd.Series): mapped tags from gen_constituents, one entry per tag per constituent
     
     Returns:
-        pd.Dataframe: Dataframe containing each tag and the number of times each tag appears in c_df
+        pd.Dataframe: Dataframe containing each tag and the number of times each tag appears in the constituents
     '''
-    tags_df = c_df[['patron_id', 'tags']].copy()
-    tags_df['tags'] = tags_df['tags'].str.split(', ')
-    tags_df = tags_df.explode('tags')
-    tag_counts_df = tags_df['tags'].value_counts().reset_index(name='tag_count')
-    tag_counts_df.rename(columns={'tags': 'tag_name'}, inplace=True)
+    tag_counts_df = exploded_tags.value_counts().rename_axis('tag_name').reset_index(name='tag_count')
     
     return tag_counts_df